@@ -1,5 +1,7 @@
 # Standard library
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Third-party
 import matplotlib.pyplot as plt
@@ -71,17 +73,43 @@ class ARModel(pl.LightningModule):
         self.register_buffer(
             "interior_mask", 1.0 - self.border_mask, persistent=False
         )  # (num_grid_nodes, 1), 1 for non-border
+        # Boolean versions, for masking and for selecting between predicted
+        # and border states
+        self.register_buffer(
+            "interior_mask_bool",
+            self.interior_mask[:, 0].to(torch.bool),
+            persistent=False,
+        )  # (num_grid_nodes,), True for non-border
+        self.register_buffer(
+            "interior_mask_bool_bcast",
+            self.interior_mask.to(torch.bool),
+            persistent=False,
+        )  # (num_grid_nodes, 1), True for non-border
 
         self.step_length = args.step_length  # Number of hours per pred. step
+        # Indices of time steps to log losses for (0-indexed)
+        self.register_buffer(
+            "val_step_log_indices",
+            torch.tensor(
+                [step - 1 for step in args.val_steps_to_log], dtype=torch.long
+            ),
+            persistent=False,
+        )  # (N_log,)
         self.val_metrics = {
-            "mse": [],
+            "mse": utils.MetricAccumulator(),
         }
         self.test_metrics = {
-            "mse": [],
-            "mae": [],
+            "mse": utils.MetricAccumulator(),
+            "mae": utils.MetricAccumulator(),
         }
         if self.output_std:
-            self.test_metrics["output_std"] = []  # Treat as metric
+            # Treat as metric
+            self.test_metrics["output_std"] = utils.MetricAccumulator()
+
+        # Optionally compile prediction step, to reduce per-step overhead
+        # when unrolling. Compiled function is created at first use.
+        self.compile_predict_step = bool(args.compile)
+        self.compiled_predict_step = None
 
         # For making restoring of optimizer state optional
         self.restore_opt = args.restore_opt
@@ -93,18 +121,54 @@ class ARModel(pl.LightningModule):
         # For storing spatial loss maps during evaluation
         self.spatial_loss_maps = []
 
+        # For writing files in background during testing,
+        # thread pool only exists during test epoch
+        self.io_pool = None
+        self.io_futures = []
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # Compiled prediction step holds a reference to this module and can
+        # not be pickled, drop it to be re-created at first use
+        state["compiled_predict_step"] = None
+        return state
+
     def configure_optimizers(self):
         opt = torch.optim.AdamW(
             self.parameters(), lr=self.args.lr, betas=(0.9, 0.95)
         )
         return opt
 
-    @property
-    def interior_mask_bool(self):
+    def save_tensor_async(self, tensor, path):
         """
-        Get the interior mask as a boolean (N,) mask.
+        Save tensor as .pt file in a background thread, without blocking
+        on the copy to host memory or the file write.
+        Only usable during test epoch, when the thread pool exists.
+
+        tensor: tensor to save, on any device
+        path: path to save tensor to
         """
-        return self.interior_mask[:, 0].to(torch.bool)
+        host_tensor = torch.empty(
+            tensor.shape,
+            dtype=tensor.dtype,
+            device="cpu",
+            pin_memory=tensor.is_cuda,
+        )
+        host_tensor.copy_(tensor, non_blocking=True)
+
+        if tensor.is_cuda:
+            # Must wait for copy to finish before saving
+            copy_event = torch.cuda.Event()
+            copy_event.record()
+        else:
+            copy_event = None
+
+        def save_after_copy():
+            if copy_event is not None:
+                copy_event.synchronize()
+            torch.save(host_tensor, path)
+
+        self.io_futures.append(self.io_pool.submit(save_after_copy))
 
     @staticmethod
     def expand_to_batch(x, batch_size):
@@ -131,42 +195,78 @@ class ARModel(pl.LightningModule):
         """
         prev_prev_state = init_states[:, 0]
         prev_state = init_states[:, 1]
+        batch_size, _, num_grid_nodes, d_f = init_states.shape
+        pred_steps = forcing_features.shape[1]
         prediction_list = []
         pred_std_list = []
-        pred_steps = forcing_features.shape[1]
+
+        if self.compile_predict_step:
+            if self.compiled_predict_step is None:
+                self.compiled_predict_step = torch.compile(self.predict_step)
+            predict_step = self.compiled_predict_step
+        else:
+            predict_step = self.predict_step
+
+        # Without gradients, write predictions directly into pre-allocated
+        # tensors instead of stacking a list of states at the end. Not done
+        # when tracking gradients, as the backward of each in-place write
+        # would copy a gradient of the full prediction tensor.
+        # Pre-allocated tensors keep the dtype of the input states also when
+        # running under mixed precision autocast.
+        write_in_place = not torch.is_grad_enabled()
+        if write_in_place:
+            prediction = init_states.new_empty(
+                (batch_size, pred_steps, num_grid_nodes, d_f)
+            )  # (B, pred_steps, num_grid_nodes, d_f)
+            if self.output_std:
+                pred_std = init_states.new_empty(
+                    (batch_size, pred_steps, num_grid_nodes, d_f)
+                )  # (B, pred_steps, num_grid_nodes, d_f)
 
         for i in range(pred_steps):
             forcing = forcing_features[:, i]
             border_state = true_states[:, i]
 
-            pred_state, pred_std = self.predict_step(
+            pred_state, step_pred_std = predict_step(
                 prev_state, prev_prev_state, forcing
             )
             # state: (B, num_grid_nodes, d_f)
-            # pred_std: (B, num_grid_nodes, d_f) or None
+            # step_pred_std: (B, num_grid_nodes, d_f) or None
 
             # Overwrite border with true state
-            new_state = (
-                self.border_mask * border_state
-                + self.interior_mask * pred_state
-            )
-
-            prediction_list.append(new_state)
-            if self.output_std:
-                pred_std_list.append(pred_std)
+            if write_in_place:
+                # Blend directly into prediction tensor. Using a view of it
+                # as conditioning state is fine, as no autograd here.
+                new_state = prediction[:, i]
+                torch.where(
+                    self.interior_mask_bool_bcast,
+                    pred_state,
+                    border_state,
+                    out=new_state,
+                )
+                if self.output_std:
+                    pred_std[:, i] = step_pred_std
+            else:
+                new_state = torch.where(
+                    self.interior_mask_bool_bcast, pred_state, border_state
+                )
+                prediction_list.append(new_state)
+                if self.output_std:
+                    pred_std_list.append(step_pred_std)
 
             # Update conditioning states
             prev_prev_state = prev_state
             prev_state = new_state
 
-        prediction = torch.stack(
-            prediction_list, dim=1
-        )  # (B, pred_steps, num_grid_nodes, d_f)
-        if self.output_std:
-            pred_std = torch.stack(
-                pred_std_list, dim=1
+        if not write_in_place:
+            prediction = torch.stack(
+                prediction_list, dim=1
             )  # (B, pred_steps, num_grid_nodes, d_f)
-        else:
+            if self.output_std:
+                pred_std = torch.stack(
+                    pred_std_list, dim=1
+                )  # (B, pred_steps, num_grid_nodes, d_f)
+        if not self.output_std:
             pred_std = self.per_var_std  # (d_f,)
 
         return prediction, pred_std
@@ -222,6 +322,25 @@ class ARModel(pl.LightningModule):
 
         returns: (K*d1, d2, ...)
         """
+        if (
+            torch.distributed.is_available()
+            and torch.distributed.is_initialized()
+            and torch.distributed.get_backend() == "nccl"
+        ):
+            # Gather directly into concatenated tensor, avoids stacking
+            tensor_to_gather = tensor_to_gather.contiguous()
+            gathered_tensor = tensor_to_gather.new_empty(
+                (
+                    torch.distributed.get_world_size()
+                    * tensor_to_gather.shape[0],
+                )
+                + tensor_to_gather.shape[1:]
+            )  # (K*d1, d2, ...)
+            torch.distributed.all_gather_into_tensor(
+                gathered_tensor, tensor_to_gather
+            )
+            return gathered_tensor
+
         return self.all_gather(tensor_to_gather).flatten(0, 1)
 
     # newer lightning versions requires batch_idx argument, even if unused
@@ -232,11 +351,15 @@ class ARModel(pl.LightningModule):
         """
         prediction, target, pred_std = self.common_step(batch)
 
+        var_loss = self.loss(
+            prediction,
+            target,
+            pred_std,
+            mask=self.interior_mask_bool,
+            sum_vars=False,
+        )  # (B, pred_steps, d_f)
         time_step_loss = torch.mean(
-            self.loss(
-                prediction, target, pred_std, mask=self.interior_mask_bool
-            ),
-            dim=0,
+            torch.sum(var_loss, dim=-1), dim=0
         )  # (time_steps-1)
         mean_loss = torch.mean(time_step_loss)
 
@@ -250,16 +373,31 @@ class ARModel(pl.LightningModule):
             val_log_dict, on_step=False, on_epoch=True, sync_dist=True
         )
 
-        # Store MSEs
-        entry_mses = metrics.mse(
-            prediction,
-            target,
-            pred_std,
-            mask=self.interior_mask_bool,
-            sum_vars=False,
-        )  # (B, pred_steps, d_f)
+        # Store MSEs, re-use loss values if training with MSE loss
+        if self.loss is metrics.mse:
+            entry_mses = var_loss
+        else:
+            entry_mses = metrics.mse(
+                prediction,
+                target,
+                pred_std,
+                mask=self.interior_mask_bool,
+                sum_vars=False,
+            )  # (B, pred_steps, d_f)
         self.val_metrics["mse"].append(entry_mses)
 
+    def on_validation_epoch_start(self):
+        """
+        Prepare storage of val metrics for all batches in val epoch
+        """
+        if self.trainer.sanity_checking:
+            num_batches = self.trainer.num_sanity_val_batches[0]
+        else:
+            num_batches = self.trainer.num_val_batches[0]
+
+        for metric_accumulator in self.val_metrics.values():
+            metric_accumulator.clear(num_batches)
+
     def on_validation_epoch_end(self):
         """
         Compute val metrics at the end of val epoch
@@ -267,9 +405,20 @@ class ARModel(pl.LightningModule):
         # Create error maps for all test metrics
         self.aggregate_and_plot_metrics(self.val_metrics, prefix="val")
 
-        # Clear lists with validation metrics values
-        for metric_list in self.val_metrics.values():
-            metric_list.clear()
+        # Clear stored validation metrics values
+        for metric_accumulator in self.val_metrics.values():
+            metric_accumulator.clear()
+
+    def on_test_epoch_start(self):
+        """
+        Prepare storage of test metrics for all batches in test epoch,
+        and thread pool for writing files
+        """
+        num_batches = self.trainer.num_test_batches[0]
+        for metric_accumulator in self.test_metrics.values():
+            metric_accumulator.clear(num_batches)
+
+        self.io_pool = ThreadPoolExecutor(max_workers=2)
 
     # pylint: disable-next=unused-argument
     def test_step(self, batch, batch_idx):
@@ -280,11 +429,18 @@ class ARModel(pl.LightningModule):
         # prediction: (B, pred_steps, num_grid_nodes, d_f)
         # pred_std: (B, pred_steps, num_grid_nodes, d_f) or (d_f,)
 
+        # Compute entry-wise loss once, reduced in different ways below
+        entry_loss = self.loss(
+            prediction, target, pred_std, average_grid=False, sum_vars=False
+        )  # (B, pred_steps, num_grid_nodes, d_f)
+        var_loss = metrics.mask_and_reduce_metric(
+            entry_loss,
+            mask=self.interior_mask_bool,
+            average_grid=True,
+            sum_vars=False,
+        )  # (B, pred_steps, d_f)
         time_step_loss = torch.mean(
-            self.loss(
-                prediction, target, pred_std, mask=self.interior_mask_bool
-            ),
-            dim=0,
+            torch.sum(var_loss, dim=-1), dim=0
         )  # (time_steps-1,)
         mean_loss = torch.mean(time_step_loss)
 
@@ -305,13 +461,17 @@ class ARModel(pl.LightningModule):
         # on_test_epoch_end
         for metric_name in ("mse", "mae"):
             metric_func = metrics.get_metric(metric_name)
-            batch_metric_vals = metric_func(
-                prediction,
-                target,
-                pred_std,
-                mask=self.interior_mask_bool,
-                sum_vars=False,
-            )  # (B, pred_steps, d_f)
+            if metric_func is self.loss:
+                # Already computed as loss
+                batch_metric_vals = var_loss
+            else:
+                batch_metric_vals = metric_func(
+                    prediction,
+                    target,
+                    pred_std,
+                    mask=self.interior_mask_bool,
+                    sum_vars=False,
+                )  # (B, pred_steps, d_f)
             self.test_metrics[metric_name].append(batch_metric_vals)
 
         if self.output_std:
@@ -322,12 +482,12 @@ class ARModel(pl.LightningModule):
             self.test_metrics["output_std"].append(mean_pred_std)
 
         # Save per-sample spatial loss for specific times
-        spatial_loss = self.loss(
-            prediction, target, pred_std, average_grid=False
+        spatial_loss = torch.sum(
+            entry_loss, dim=-1
         )  # (B, pred_steps, num_grid_nodes)
-        log_spatial_losses = spatial_loss[
-            :, [step - 1 for step in self.args.val_steps_to_log]
-        ]
+        log_spatial_losses = spatial_loss.index_select(
+            1, self.val_step_log_indices
+        )
         self.spatial_loss_maps.append(log_spatial_losses)
         # (B, N_log, num_grid_nodes)
 
@@ -359,29 +519,33 @@ class ARModel(pl.LightningModule):
 
         target = batch[1]
 
-        # Rescale to original data scale
-        prediction_rescaled = prediction * self.data_std + self.data_mean
-        target_rescaled = target * self.data_std + self.data_mean
+        # Rescale to original data scale, only examples to plot
+        prediction_rescaled = torch.addcmul(
+            self.data_mean, prediction[:n_examples], self.data_std
+        )
+        target_rescaled = torch.addcmul(
+            self.data_mean, target[:n_examples], self.data_std
+        )
 
         # Iterate over the examples
         for pred_slice, target_slice in zip(
-            prediction_rescaled[:n_examples], target_rescaled[:n_examples]
+            prediction_rescaled, target_rescaled
         ):
             # Each slice is (pred_steps, num_grid_nodes, d_f)
             self.plotted_examples += 1  # Increment already here
 
             var_vmin = (
                 torch.minimum(
-                    pred_slice.flatten(0, 1).min(dim=0)[0],
-                    target_slice.flatten(0, 1).min(dim=0)[0],
+                    pred_slice.amin(dim=(0, 1)),
+                    target_slice.amin(dim=(0, 1)),
                 )
                 .cpu()
                 .numpy()
             )  # (d_f,)
             var_vmax = (
                 torch.maximum(
-                    pred_slice.flatten(0, 1).max(dim=0)[0],
-                    target_slice.flatten(0, 1).max(dim=0)[0],
+                    pred_slice.amax(dim=(0, 1)),
+                    target_slice.amax(dim=(0, 1)),
                 )
                 .cpu()
                 .numpy()
@@ -389,29 +553,47 @@ class ARModel(pl.LightningModule):
             var_vranges = list(zip(var_vmin, var_vmax))
 
             # Iterate over prediction horizon time steps
+            var_figs = None
             for t_i, (pred_t, target_t) in enumerate(
                 zip(pred_slice, target_slice), start=1
             ):
-                # Create one figure per variable at this time step
-                var_figs = [
-                    vis.plot_prediction(
-                        pred_t[:, var_i],
-                        target_t[:, var_i],
-                        self.interior_mask[:, 0],
-                        self.config_loader,
-                        title=f"{var_name} ({var_unit}), "
-                        f"t={t_i} ({self.step_length * t_i} h)",
-                        vrange=var_vrange,
-                    )
-                    for var_i, (var_name, var_unit, var_vrange) in enumerate(
-                        zip(
-                            self.config_loader.dataset.var_names,
-                            self.config_loader.dataset.var_units,
-                            var_vranges,
-                        )
+                var_titles = [
+                    f"{var_name} ({var_unit}), "
+                    f"t={t_i} ({self.step_length * t_i} h)"
+                    for var_name, var_unit in zip(
+                        self.config_loader.dataset.var_names,
+                        self.config_loader.dataset.var_units,
                     )
                 ]
 
+                if var_figs is None:
+                    # Create one figure per variable at first time step
+                    var_figs = [
+                        vis.plot_prediction(
+                            pred_t[:, var_i],
+                            target_t[:, var_i],
+                            self.interior_mask[:, 0],
+                            self.config_loader,
+                            title=var_title,
+                            vrange=var_vrange,
+                        )
+                        for var_i, (var_title, var_vrange) in enumerate(
+                            zip(var_titles, var_vranges)
+                        )
+                    ]
+                else:
+                    # Re-use figures, only update plotted data and titles
+                    for var_i, (fig, var_title) in enumerate(
+                        zip(var_figs, var_titles)
+                    ):
+                        vis.update_prediction(
+                            fig,
+                            pred_t[:, var_i],
+                            target_t[:, var_i],
+                            self.config_loader,
+                            title=var_title,
+                        )
+
                 example_i = self.plotted_examples
                 wandb.log(
                     {
@@ -421,19 +603,17 @@ class ARModel(pl.LightningModule):
                         )
                     }
                 )
-                plt.close(
-                    "all"
-                )  # Close all figs for this time step, saves memory
+            plt.close("all")  # Close all figs for this example, saves memory
 
             # Save pred and target as .pt files
-            torch.save(
-                pred_slice.cpu(),
+            self.save_tensor_async(
+                pred_slice,
                 os.path.join(
                     wandb.run.dir, f"example_pred_{self.plotted_examples}.pt"
                 ),
             )
-            torch.save(
-                target_slice.cpu(),
+            self.save_tensor_async(
+                target_slice,
                 os.path.join(
                     wandb.run.dir, f"example_target_{self.plotted_examples}.pt"
                 ),
@@ -489,14 +669,14 @@ class ARModel(pl.LightningModule):
         """
         Aggregate and create error map plots for all metrics in metrics_dict
 
-        metrics_dict: dictionary with metric_names and list of tensors
+        metrics_dict: dictionary with metric_names and MetricAccumulators
             with step-evals.
         prefix: string, prefix to use for logging
         """
         log_dict = {}
-        for metric_name, metric_val_list in metrics_dict.items():
+        for metric_name, metric_accumulator in metrics_dict.items():
             metric_tensor = self.all_gather_cat(
-                torch.cat(metric_val_list, dim=0)
+                metric_accumulator.get()
             )  # (N_eval, pred_steps, d_f)
 
             if self.trainer.is_global_zero:
@@ -550,9 +730,10 @@ class ARModel(pl.LightningModule):
                 )
             ]
 
-            # log all to same wandb key, sequentially
-            for fig in loss_map_figs:
-                wandb.log({"test_loss": wandb.Image(fig)})
+            # log all to same wandb key, in a single call
+            wandb.log(
+                {"test_loss": [wandb.Image(fig) for fig in loss_map_figs]}
+            )
 
             # also make without title and save as pdf
             pdf_loss_map_figs = [
@@ -566,13 +747,22 @@ class ARModel(pl.LightningModule):
             for t_i, fig in zip(self.args.val_steps_to_log, pdf_loss_map_figs):
                 fig.savefig(os.path.join(pdf_loss_maps_dir, f"loss_t{t_i}.pdf"))
             # save mean spatial loss as .pt file also
-            torch.save(
-                mean_spatial_loss.cpu(),
+            self.save_tensor_async(
+                mean_spatial_loss,
                 os.path.join(wandb.run.dir, "mean_spatial_loss.pt"),
             )
 
         self.spatial_loss_maps.clear()
 
+        # Make sure all files are written before test run ends
+        try:
+            for future in self.io_futures:
+                future.result()  # Re-raises any exception from writing
+        finally:
+            self.io_pool.shutdown(wait=True)
+            self.io_pool = None
+            self.io_futures.clear()
+
     def on_load_checkpoint(self, checkpoint):
         """
         Perform any changes to state dict before loading checkpoint
@@ -582,18 +772,28 @@ class ARModel(pl.LightningModule):
         # Fix for loading older models after IneractionNet refactoring, where
         # the grid MLP was moved outside the encoder InteractionNet class
         if "g2m_gnn.grid_mlp.0.weight" in loaded_state_dict:
-            replace_keys = list(
-                filter(
-                    lambda key: key.startswith("g2m_gnn.grid_mlp"),
-                    loaded_state_dict.keys(),
+            old_prefix = "g2m_gnn.grid_mlp"
+            new_prefix = "encoding_grid_mlp"
+            # Rebuild state dict in one pass, renaming matching keys
+            renamed_state_dict = OrderedDict(
+                (
+                    (
+                        new_prefix + key[len(old_prefix) :]
+                        if key.startswith(old_prefix)
+                        else key
+                    ),
+                    value,
                 )
+                for key, value in loaded_state_dict.items()
             )
-            for old_key in replace_keys:
-                new_key = old_key.replace(
-                    "g2m_gnn.grid_mlp", "encoding_grid_mlp"
-                )
-                loaded_state_dict[new_key] = loaded_state_dict[old_key]
-                del loaded_state_dict[old_key]
-        if not self.restore_opt:
+            # Keep metadata used by load_state_dict for version handling
+            metadata = getattr(loaded_state_dict, "_metadata", None)
+            if metadata is not None:
+                # pylint: disable-next=protected-access
+                renamed_state_dict._metadata = metadata
+            checkpoint["state_dict"] = renamed_state_dict
+        # Optimizer state is not restored when only evaluating, so no need
+        # to construct a fresh one then
+        if not self.restore_opt and not self.args.eval:
             opt = self.configure_optimizers()
             checkpoint["optimizer_states"] = [opt.state_dict()]
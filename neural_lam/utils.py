@@ -1,4 +1,5 @@
 # Standard library
+import math
 import os
 
 # Third-party
@@ -107,6 +108,62 @@ class BufferList(nn.Module):
         return (self[i] for i in range(len(self)))
 
 
+class MetricAccumulator:
+    """
+    Accumulates per-sample metric values over an evaluation epoch in a
+    pre-allocated tensor, instead of concatenating a list of batch tensors
+    at the end of the epoch.
+    """
+
+    def __init__(self):
+        self.values = None
+        self.num_stored = 0
+        self.num_batches = 1
+
+    def clear(self, num_batches=1):
+        """
+        Remove all stored values
+
+        num_batches: number of batches expected to be stored next,
+            used to size pre-allocated tensor
+        """
+        self.values = None
+        self.num_stored = 0
+        if math.isfinite(num_batches):
+            self.num_batches = max(int(num_batches), 1)
+        else:
+            self.num_batches = 1
+
+    def append(self, batch_values):
+        """
+        Store metric values for a batch
+
+        batch_values: (B, ...), metric values for each sample in batch
+        """
+        batch_size = batch_values.shape[0]
+        if self.values is None:
+            # Allocate for all expected batches, assuming full batches
+            self.values = batch_values.new_empty(
+                (self.num_batches * batch_size,) + batch_values.shape[1:]
+            )  # (N_alloc, ...)
+
+        new_num_stored = self.num_stored + batch_size
+        while new_num_stored > self.values.shape[0]:
+            # More values than expected, double size of storage
+            self.values = torch.cat(
+                (self.values, torch.empty_like(self.values)), dim=0
+            )
+
+        self.values[self.num_stored : new_num_stored] = batch_values
+        self.num_stored = new_num_stored
+
+    def get(self):
+        """
+        Get all stored values, shape (N_stored, ...)
+        """
+        return self.values[: self.num_stored]
+
+
 def load_graph(graph_name, device="cpu"):
     """
     Load all tensors representing the graph
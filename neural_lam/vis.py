@@ -115,6 +115,24 @@ def plot_prediction(
     return fig
 
 
+@matplotlib.rc_context(utils.fractional_plot_bundle(1))
+def update_prediction(fig, pred, target, data_config, title=None):
+    """
+    Update figure created by plot_prediction with new prediction and
+    ground truth, re-using axes, coastlines and colorbar.
+    Each has shape (N_grid,)
+    """
+    # First two axes are target and pred, last is colorbar
+    for ax, data in zip(fig.axes[:2], (target, pred)):
+        data_grid = data.reshape(*data_config.grid_shape_state).cpu().numpy()
+        ax.images[0].set_data(data_grid)
+
+    if title:
+        fig.suptitle(title, size=20)  # Replaces existing title
+
+    return fig
+
+
 @matplotlib.rc_context(utils.fractional_plot_bundle(1))
 def plot_spatial_error(error, obs_mask, data_config, title=None, vrange=None):
     """
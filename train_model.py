@@ -82,7 +82,15 @@ def main():
         "--precision",
         type=str,
         default=32,
-        help="Numerical precision to use for model (32/16/bf16) (default: 32)",
+        help="Numerical precision to use for model (32/16-mixed/bf16-mixed), "
+        "mixed precision runs the model under autocast (default: 32)",
+    )
+    parser.add_argument(
+        "--compile",
+        type=int,
+        default=0,
+        help="If the prediction step should be compiled using torch.compile "
+        "(default: 0 (false))",
     )
 
     # Model architecture